@@ -1,12 +1,38 @@
 # -*- coding: utf-8 -*-
 """ Calculate isotopic interference and standard ratios. """
 
+import numpy as np
 import pandas as pd
-import itertools
-from interference_calculator.molecule import Molecule, mass_electron, periodic_table
+from interference_calculator.molecule import Molecule, mass_electron, periodic_table, _format_composition, _cached_format
+
+def _repeats(ids):
+    """ For each row of sorted ids, return the product of the factorials of
+        the number of times each id occurs, e.g. [1, 1, 1, 4, 4] -> 3! * 2! = 12.
+    """
+    run = np.ones(ids.shape[0])
+    product = np.ones(ids.shape[0])
+    for col in range(1, ids.shape[1]):
+        run = np.where(ids[:, col] == ids[:, col - 1], run + 1, 1)
+        product *= run
+    return product
+
+def _add_atom(combos, n):
+    """ Given all combinations with replacement of range(n) as rows of
+        sorted indices, return all combinations with one more index,
+        in the same order as itertools.combinations_with_replacement.
+    """
+    if combos.shape[1]:
+        start = combos[:, -1]
+    else:
+        start = np.zeros(combos.shape[0], dtype=int)
+    repeats = n - start
+    rows = np.repeat(combos, repeats, axis=0)
+    # For each old row, count up from its last index to n - 1.
+    offsets = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    return np.column_stack((rows, np.repeat(start, repeats) + offsets))
 
 def interference(atoms, target, targetrange=0.3, maxsize=5, charge=[1],
-                 chargesign='-', style='plain'):
+                 chargesign='-', style='plain', minabundance=0):
     """ For a list of atoms (the composition of the sample),
         calculate all molecules that can be formed from a
         combination of those atoms (the interferences),
@@ -34,6 +60,9 @@ def interference(atoms, target, targetrange=0.3, maxsize=5, charge=[1],
         Molecular formulas are formatted in style (default is 'plain').
         See Molecule() for more options.
 
+        Combinations of isotopes with a probability below minabundance
+        are left out (default is 0, keep all).
+
         Returns a pandas.DataFrame with a column 'molecule' with molecular formula,
         a column 'charge', a column 'mass/charge' for the mass-to-charge ratio, a
         column 'mass/charge diff' for the mass/charge difference between this ion
@@ -104,95 +133,124 @@ def interference(atoms, target, targetrange=0.3, maxsize=5, charge=[1],
         target_abun = 0
 
     # Retrieve info from perioic table for all atoms in sample.
-    # Create a list with all possible combinations up to maxsize atoms.
-    # Create same list for masses, combos are created in same order.
+    # Create all possible combinations up to maxsize atoms, as rows of
+    # indices into picked_atoms. For each combination, list the isotopes
+    # and calculate the total mass and the combinatorial probability
+    # (see Molecule.relative_abundance()).
+    # Rows of idx are sorted, so _repeats() can only count the atoms of
+    # each element if isotopes of one element are next to each other:
+    # keep picked_atoms in order of atomic number.
     picked_atoms = periodic_table[periodic_table['element'].isin(atoms)]
-    isotope_combos = []
-    mass_combos = []
-    for size in range(1, maxsize + 1):
-        i = itertools.combinations_with_replacement(picked_atoms['isotope'], size)
-        m = itertools.combinations_with_replacement(picked_atoms['mass'], size)
-        isotope_combos.extend(list(i))
-        mass_combos.extend(list(m))
+    picked_atoms = picked_atoms.sort_values('atomic number', kind='mergesort')
+    isotopes = picked_atoms['isotope'].values
+    isotope_masses = picked_atoms['mass'].values
+    abundances = picked_atoms['abundance'].values
+    atomic_numbers = picked_atoms['atomic number'].values
+    atomic_masses = picked_atoms['atomic mass'].values
+    elements = picked_atoms['element'].values
+    index_combos = []
+    masses = []
+    probabilities = []
 
-    masses = pd.DataFrame(mass_combos).sum(axis=1)
-    molecules = [' '.join(m) for m in isotope_combos]
-    data = pd.DataFrame({'molecule': molecules,
-                         'mass/charge': masses})
-
-    # ignore charge(s) for sign o
+    # Ignore charge(s) for sign o.
     if chargesign in ('o', '0'):
-        data['charge'] = 0
-    else:
-        data_w_charge = []
-        for ch in charge:
-            d = data.copy()
-            d['charge'] = ch
-            if ch == 0:
-                data_w_charge.append(d)
+        charge = (0,)
+
+    # Skip sizes for which no combination can reach the target window;
+    # charge 0 does not divide the mass.
+    if target and len(isotopes):
+        divisors = [ch or 1 for ch in charge]
+        lightest = isotope_masses.min() / max(divisors) - mass_electron
+        heaviest = isotope_masses.max() / min(divisors) + mass_electron
+
+    idx = np.zeros((1, 0), dtype=int)
+    for size in range(1, maxsize + 1):
+        idx = _add_atom(idx, len(isotopes))
+        if target and len(isotopes):
+            if size * lightest > target_mz + targetrange:
+                break
+            if size * heaviest < target_mz - targetrange:
                 continue
-            elif ch == 1:
-                charge_str = ' {}'.format(chargesign)
-            else:
-                charge_str = ' {}{}'.format(ch, chargesign)
-            d['molecule'] += charge_str
-            d['mass/charge'] /= ch
-            if chargesign == '+':
-                d['mass/charge'] -= mass_electron
-            else:
-                d['mass/charge'] += mass_electron
-            data_w_charge.append(d)
-        data = pd.concat(data_w_charge)
+        probability = (abundances[idx].prod(axis=1) *
+                       _repeats(atomic_numbers[idx]) / _repeats(idx))
+        keep = probability >= minabundance
+        index_combos.extend(tuple(i) for i in idx[keep].tolist())
+        masses.append(isotope_masses[idx[keep]].sum(axis=1))
+        probabilities.append(probability[keep])
+
+    masses = np.concatenate(masses) if masses else np.zeros(0)
+    probabilities = np.concatenate(probabilities) if probabilities else np.zeros(0)
+
+    # Repeat all combinations for each charge, adjust mass for charge and
+    # extra (-) or missing (+) electrons, and only keep those within the
+    # target window.
+    combos = []
+    charges = []
+    mz = []
+    for ch in charge:
+        if ch == 0:
+            m = masses
+        elif chargesign == '+':
+            m = masses / ch - mass_electron
+        else:
+            m = masses / ch + mass_electron
+        if target:
+            keep = np.nonzero((m >= target_mz - targetrange) &
+                              (m <= target_mz + targetrange))[0]
+        else:
+            keep = np.arange(len(m))
+        combos.append(keep)
+        charges.append(np.full(len(keep), ch, dtype=int))
+        mz.append(m[keep])
+    combos = np.concatenate(combos)
+    charges = np.concatenate(charges)
+    mz = np.concatenate(mz)
 
     if target:
-        data = data.loc[(data['mass/charge'] >= target_mz - targetrange)
-                      & (data['mass/charge'] <= target_mz + targetrange)]
-        data['mass/charge diff'] = data['mass/charge'] - target_mz
-        data['MRP'] = target_mz/data['mass/charge diff'].abs()
+        diff = mz - target_mz
+        with np.errstate(divide='ignore'):
+            mrp = target_mz/np.abs(diff)
     else:
-        data['mass/charge diff'] = 0.0
-        data['MRP'] = pd.np.inf
+        diff = np.zeros(len(mz))
+        mrp = np.full(len(mz), np.inf)
 
+    # Format the molecules straight from the isotope combinations.
     molec = []
-    abun = []
-    for molecule in data['molecule'].values:
-        m = Molecule(molecule)
-        abun.append(m.abundance)
-        molec.append(m.formula(style=style))
-
-    data['molecule'] = molec
-    data['probability'] = abun
-    data['target'] = False
-    target_data = {
-        'molecule': target,
-        'charge': target_charge,
-        'mass/charge': target_mz,
-        'mass/charge diff': 0,
-        'MRP': pd.np.inf,
-        'probability': target_abun,
-        'target': True
-    }
-    data = data.append(target_data, ignore_index=True)
+    for c, ch in zip(combos, charges):
+        combo = index_combos[c]
+        # Same order as Molecule: sorted by isotope label.
+        unique = sorted(set(combo), key=lambda i: isotopes[i])
+        counts = [combo.count(i) for i in unique]
+        molec.append(_cached_format([isotopes[i] for i in unique],
+                                    [atomic_masses[i] for i in unique],
+                                    [elements[i] for i in unique],
+                                    counts, ch, chargesign, style))
+
+    # Build the output in one go, with the target as the last row.
+    data = pd.DataFrame({
+        'molecule': pd.Series(molec + [target], dtype=object),
+        'charge': np.append(charges, target_charge),
+        'mass/charge': np.append(mz, target_mz),
+        'mass/charge diff': np.append(diff, 0.0),
+        'MRP': np.append(mrp, np.inf),
+        'probability': np.append(probabilities[combos], target_abun),
+        'target': [False] * len(molec) + [True]
+    })
     return data[['molecule', 'charge', 'mass/charge',
                  'mass/charge diff', 'MRP', 'probability', 'target']]
 
 def standard_ratio(atoms, style='plain'):
     """ Give the stable isotopes and their standard abundance for the given element(s). """
     data = periodic_table[periodic_table['element'].isin(atoms)].copy()
-    data['ratio'] = 1.0
-    data['inverse ratio'] = 1.0
-    for a in atoms:
-        abun = data.loc[data['element'] == a, 'abundance'].copy()
-        ratio = abun/abun.max()
-        inv_ratio = 1/ratio
-        data.loc[data['element'] == a, 'ratio'] = ratio
-        data.loc[data['element'] == a, 'inverse ratio'] = inv_ratio
+    max_abun = data.groupby('element')['abundance'].transform('max')
+    data['ratio'] = data['abundance']/max_abun
+    data['inverse ratio'] = 1/data['ratio']
 
     if style != 'plain':
         pretty_isotopes = []
-        for i in data['isotope'].values:
-            m = Molecule(i)
-            pretty_isotopes.append(m.formula(style=style, show_charge=False, all_isotopes=True))
+        for am, el in zip(data['atomic mass'].values, data['element'].values):
+            pretty_isotopes.append(_format_composition([am], [el], [1], style=style,
+                                                       show_charge=False, all_isotopes=True))
         data['isotope'] = pretty_isotopes
 
     return data[['isotope', 'mass', 'abundance', 'ratio', 'inverse ratio', 'standard']]
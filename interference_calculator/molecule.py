@@ -4,16 +4,33 @@
     The chemical formula can be output in a number of ways, including custom
     formatting using simple templates.
 """
+import numpy as np
 import pandas as pd
 import pyparsing as pp
 import pkg_resources
+import re
 
-from numpy import prod
-from scipy.misc import factorial
+from collections import Counter
+from math import factorial
 
 _periodic_table_file = pkg_resources.resource_filename(__name__, 'periodic_table.csv')
 periodic_table = pd.read_csv(_periodic_table_file, comment='#')
 
+# Element and isotope labels from periodic_table; parse() stores these string
+# objects instead of the ones it builds, so all molecules share them.
+_labels = {s: s for s in set(periodic_table['element']).union(periodic_table['isotope'])}
+
+# Row number of each isotope in periodic_table, and the columns needed by
+# Molecule as plain arrays, so that look-ups don't have to scan the table.
+_isotope_index = {_labels[i]: n for n, i in enumerate(periodic_table['isotope'].values)}
+_atomic_numbers = periodic_table['atomic number'].values
+_masses = periodic_table['mass'].values
+_abundances = periodic_table['abundance'].values
+_major_isotopes = periodic_table['major isotope'].values
+_major_isotope_set = frozenset(_major_isotopes)
+_major = periodic_table[periodic_table['isotope'] == periodic_table['major isotope']]
+_element_major_mass = dict(zip(_major['element'].values, _major['atomic mass'].tolist()))
+
 # CODATA 2014, http://physics.nist.gov/cgi-bin/cuu/Value?me
 mass_electron = 0.0005485799090
 
@@ -35,7 +52,7 @@ _charged = pp.oneOf('+ -')
 # molecule    ::= one or more units + [charge]
 #
 
-_in_delimiter = pp.CharsNotIn(pp.alphanums + '+-').setParseAction(pp.replaceWith(','))
+_in_delimiter = re.compile(r'[^A-Za-z0-9+\-]+')
 _in_comma = pp.Optional(pp.Suppress(','))
 _in_unit = pp.OneOrMore(pp.Group(
                 _opt_int('atomic_mass') + _element('element') + _opt_int('count') + _in_comma
@@ -44,7 +61,9 @@ _in_charge = pp.Optional(
                 _neutral('charge_sign') |
                 _opt_int('charge_count') + _charged('charge_sign')
              )
-_in_molecule = _in_unit('units') + _in_charge
+# parse() replaces delimiters, whitespace included, by commas first,
+# so don't make pyparsing skip whitespace before every token.
+_in_molecule = (_in_unit('units') + _in_charge).leaveWhitespace()
 
 ### molecular notation in Backus-Naur form (-ish)
 # example: C2H5COOCH[15]NH3[+]
@@ -68,7 +87,13 @@ _mn_charge = pp.Optional(
                     _opt_int('charge_count') + _charged('charge_sign')
                 ) + pp.Suppress(']')
             )
-_mn_molecule = _mn_unit('units') + _mn_charge
+# Most input has no whitespace, so don't make pyparsing skip it before
+# every token. Input that does, e.g. 'H2O [-]', is parsed with the
+# slower, whitespace-skipping _mn_molecule_spaced (see parse()).
+_mn_molecule = (_mn_unit('units') + _mn_charge).leaveWhitespace()
+_mn_molecule_spaced = _mn_unit('units') + _mn_charge
+_not_molecular = re.compile(r'[^A-Za-z0-9\[\]+\-\s]')
+_whitespace = re.compile(r'\s')
 
 # Just a list of names to choose from, for convenience.
 templates = ['html', 'latex', 'mhchem', 'isotope', 'plain', 'molecular']
@@ -133,9 +158,34 @@ molecular_template = {
     'end': ''
 }
 
+# Template used by each built-in style.
+_style_templates = {
+    'html': html_template,
+    'latex': latex_template,
+    'mhchem': mhchem_template,
+    'molecular': molecular_template,
+    'plain': isotope_template,
+    'isotope': isotope_template
+}
+
+def _copy(value):
+    """ Shallow copy of lists, other values are returned as is. """
+    if isinstance(value, list):
+        return value[:]
+    return value
+
+# Parsed molecules, keyed on input string. The same formulas are parsed
+# over and over again, e.g. by the GUI on every calculation.
+_molecule_cache = {}
+_molecule_cache_size = 65536
+
 class Molecule(object):
     """ Represents a molecule or molecular ion. """
 
+    __slots__ = ('input', 'mass', 'abundance', 'charge', 'chargesign',
+                 'elements', 'isotopes', 'counts', 'atomic_numbers',
+                 'atomic_masses', 'masses', 'abundances', '_molecular_formula')
+
     def __init__(self, molecule):
         """ Parses a chemical formula string and returns an object that
             holds properties of the molecule or molecular ion.
@@ -185,10 +235,29 @@ class Molecule(object):
         self.atomic_masses = []
         self.masses = []
         self.abundances = []
-
-        self.parse()
-        self.relative_abundance()
-        self.molecular_formula = self.formula()
+        self._molecular_formula = None
+
+        if molecule:
+            molecule = molecule.strip()
+        cached = _molecule_cache.get(molecule)
+        if cached is None:
+            self.parse()
+            self.relative_abundance()
+            if len(_molecule_cache) >= _molecule_cache_size:
+                _molecule_cache.clear()
+            _molecule_cache[molecule] = [_copy(getattr(self, k)) for k in self.__slots__]
+        else:
+            # Copy the lists, so that changes to this molecule
+            # don't end up in the cache.
+            for k, v in zip(self.__slots__, cached):
+                setattr(self, k, _copy(v))
+
+    @property
+    def molecular_formula(self):
+        """ The molecular formula in the default style, see formula(). """
+        if self._molecular_formula is None:
+            self._molecular_formula = self.formula()
+        return self._molecular_formula
 
     def __str__(self):
         return self.input + ' --> ' + self.molecular_formula
@@ -201,31 +270,31 @@ class Molecule(object):
             return
         self.input = self.input.strip()
 
-        # Parse input string into pyparsing.ParseResult objects
-        try:
-            molec = _mn_molecule.parseString(self.input, parseAll=True)
-        except pp.ParseException:
-            delim_string = _in_delimiter.transformString(self.input)
+        # Parse input string into pyparsing.ParseResult objects.
+        # Only try molecular notation if the input has no characters
+        # that can't occur in it, such as the delimiters of isotope notation.
+        molec = None
+        if not _not_molecular.search(self.input):
+            if _whitespace.search(self.input):
+                mn_molecule = _mn_molecule_spaced
+            else:
+                mn_molecule = _mn_molecule
+            try:
+                molec = mn_molecule.parseString(self.input, parseAll=True)
+            except pp.ParseException:
+                pass
+        if molec is None:
+            delim_string = _in_delimiter.sub(',', self.input)
             molec = _in_molecule.parseString(delim_string, parseAll=True)
 
         # Collect data from ParseResult objects,
         # merge mulitple occurances of same element.
-        data = {}
+        data = Counter()
         for unit in molec.units:
-            label = unit.atomic_mass + unit.element
-            if label not in data.keys():
-                data[label] = {
-                    'atomic_mass': unit.atomic_mass,
-                    'element': unit.element,
-                    'count': int(unit.get('count', 1))
-                }
-            else:
-                data[label]['count'] += int(unit.get('count', 1))
+            data[(unit.atomic_mass, unit.element)] += int(unit.get('count', 1))
 
-        # Sort and split data into lists.
-        for k in sorted(data.keys()):
-            am = data[k]['atomic_mass']
-            el = data[k]['element']
+        # Sort (on label, e.g. '13C') and split data into lists.
+        for (am, el), count in sorted(data.items(), key=lambda u: u[0][0] + u[0][1]):
             if el == 'D':
                 # special case
                 el = 'H'
@@ -234,23 +303,21 @@ class Molecule(object):
                 am = int(am)
             else:
                 # no atomic mass given, find major isotope, e.g. C -> 12C
-                am = periodic_table[periodic_table['element'] == el].iloc[0].loc['major isotope']
-                am = int(am.strip(el))
+                am = _element_major_mass[el]
+            isotope = str(am) + el
             self.atomic_masses.append(am)
-            self.elements.append(el)
-            self.isotopes.append(str(am) + el)
-            self.counts.append(data[k]['count'])
+            self.elements.append(_labels.get(el, el))
+            self.isotopes.append(_labels.get(isotope, isotope))
+            self.counts.append(count)
 
         # Retrieve additional information from periodic table
-        for i in self.isotopes:
-            isotope = periodic_table[periodic_table['isotope'] == i].iloc[0]
-            self.atomic_numbers.append(isotope['atomic number'])
-            self.masses.append(isotope['mass'])
-            self.abundances.append(isotope['abundance'])
+        rows = [_isotope_index[i] for i in self.isotopes]
+        self.atomic_numbers = list(_atomic_numbers[rows])
+        self.masses = list(_masses[rows])
+        self.abundances = list(_abundances[rows])
 
         # Calculate total mass of molecule
-        for m, c in zip(self.masses, self.counts):
-            self.mass += m * c
+        self.mass = float(np.dot(_masses[rows], self.counts))
 
         # Find charge and sign
         self.chargesign = molec.get('charge_sign', '')
@@ -298,23 +365,24 @@ class Molecule(object):
         # for 16O: xi = 2, for 18O: xi = 1
         # for 16O: pi = 0.9976 for 18O: pi = 0.002 (and 0.0004 for 17O)
 
-        data = periodic_table[periodic_table['isotope'].isin(self.isotopes)].copy()
-        data['count'] = self.counts
-
-        parents = data['major isotope'].value_counts().to_dict()
-        abun_per_el = []
-        for el, k in parents.items():
-            d = data[data['major isotope'] == el]
-            n = d['count'].sum()
+        # Group counts and abundances by parent element (major isotope).
+        parents = {}
+        for i, c, p in zip(self.isotopes, self.counts, self.abundances):
+            parent = _major_isotopes[_isotope_index[i]]
+            parents.setdefault(parent, []).append((c, p))
 
-            if k == 1:
+        self.abundance = 1.0
+        for units in parents.values():
+            if len(units) == 1:
                 # Simple case of single isotope, even if it occurs n times
-                abun = d['abundance'].iat[0] ** n
+                c, p = units[0]
+                self.abundance *= p ** c
             else:
-                abun = factorial(n)/factorial(d['count']).prod() * (d['abundance'] ** d['count']).prod()
-
-            abun_per_el.append(abun)
-        self.abundance = prod(abun_per_el)
+                n = sum(c for c, p in units)
+                abun = float(factorial(n))
+                for c, p in units:
+                    abun = abun / factorial(c) * p ** c
+                self.abundance *= abun
 
     def formula(self, style='plain', HtoD=True, show_charge=True, all_isotopes=False, template={}):
         """ Return the molecular formula as a string.
@@ -352,73 +420,140 @@ class Molecule(object):
             strings are added to the beginning and end of the final
             output string, respectively.
         """
-        # Force copy of list without using list.copy (python 2)
-        elem = list(self.elements)
-        amass = [str(u) for u in self.atomic_masses]
-        count = [str(c) if c > 1 else '' for c in self.counts]
-
-        if HtoD:
-            for n, (am, el) in enumerate(zip(amass, elem)):
-                if el == 'H':
-                    if am == '1':
-                        amass[n] = ''
-                    elif am == '2':
-                        amass[n] = ''
-                        elem[n] = 'D'
-
-        if style == 'html':
-            templ = html_template
-        elif style == 'latex':
-            templ = latex_template
-        elif style == 'mhchem':
-            templ = mhchem_template
-        elif style == 'molecular':
-            templ = molecular_template
-        elif style in ('plain', 'isotope'):
-            templ = isotope_template
-        elif style == 'custom':
-            if not template:
-                raise ValueError('If you select style="custom", you must supply a custom template.')
-            templ = template
+        if style == 'custom':
+            return _format_composition(self.atomic_masses, self.elements, self.counts,
+                                       self.charge, self.chargesign, style=style,
+                                       HtoD=HtoD, show_charge=show_charge,
+                                       all_isotopes=all_isotopes, template=template)
+
+        return _cached_format(self.isotopes, self.atomic_masses, self.elements, self.counts,
+                              self.charge, self.chargesign, style, HtoD=HtoD,
+                              show_charge=show_charge, all_isotopes=all_isotopes)
+
+
+# Formatted formulas for the built-in styles, keyed on isotopes, counts,
+# charge, sign, style, the HtoD, show_charge, and all_isotopes options,
+# and the contents of the style's template, which can be changed.
+_formula_cache = {}
+_formula_cache_size = 65536
+
+def _cached_format(isotopes, atomic_masses, elements, counts, charge, chargesign, style,
+                   HtoD=True, show_charge=True, all_isotopes=False):
+    """ Format a composition in one of the built-in styles, or return the
+        formula from _formula_cache if it was formatted before.
+    """
+    templ = tuple(sorted(_style_templates.get(style, {}).items()))
+    key = (tuple(isotopes), tuple(counts), charge, chargesign,
+           style, HtoD, show_charge, all_isotopes, templ)
+    formula = _formula_cache.get(key)
+    if formula is None:
+        formula = _format_composition(atomic_masses, elements, counts, charge,
+                                      chargesign, style=style, HtoD=HtoD,
+                                      show_charge=show_charge,
+                                      all_isotopes=all_isotopes)
+        if len(_formula_cache) >= _formula_cache_size:
+            _formula_cache.clear()
+        _formula_cache[key] = formula
+    return formula
+
+# Atomic mass and element to show for H isotopes with HtoD=True.
+_hydrogen_labels = {'1': ('', 'H'), '2': ('', 'D')}
+
+def _format_composition(atomic_masses, elements, counts, charge=0, chargesign='',
+                        style='plain', HtoD=True, show_charge=True, all_isotopes=False,
+                        template={}):
+    """ Format a molecular formula from lists of atomic masses, elements,
+        and counts, plus a charge and charge sign, without parsing a
+        formula string. See Molecule.formula() for the other options.
+    """
+    # Convert to strings in one pass. Show 1H and 2H as H and D if HtoD
+    # is set, and only show atomic masses of minor isotopes, unless
+    # all_isotopes is set.
+    amass = []
+    elem = []
+    count = []
+    for am, el, ct in zip(atomic_masses, elements, counts):
+        am = str(am)
+        if HtoD and el == 'H' and am in _hydrogen_labels:
+            am, el = _hydrogen_labels[am]
+        elif not all_isotopes and am + el in _major_isotope_set:
+            am = ''
+        amass.append(am)
+        elem.append(el)
+        count.append(str(ct) if ct > 1 else '')
+
+    if style == 'html':
+        templ = html_template
+    elif style == 'latex':
+        templ = latex_template
+    elif style == 'mhchem':
+        templ = mhchem_template
+    elif style == 'molecular':
+        templ = molecular_template
+    elif style in ('plain', 'isotope'):
+        templ = isotope_template
+    elif style == 'custom':
+        if not template:
+            raise ValueError('If you select style="custom", you must supply a custom template.')
+        templ = template
+    else:
+        msg = 'style must be one of "html", "latex", "mhchem", '
+        msg += '"plain", "isotope", "molecular", or "custom".'
+        raise ValueError(msg)
+
+    if show_charge:
+        if chargesign == '-' and templ['minus']:
+            chargesign = templ['minus']
+
+        if charge == 0:
+            charge = ''
+        elif charge == 1:
+            charge = chargesign
         else:
-            msg = 'style must be one of "html", "latex", "mhchem", '
-            msg += '"plain", "isotope", "molecular", or "custom".'
-            raise ValueError(msg)
+            charge = str(charge) + chargesign
+    else:
+        charge = ''
 
-        if show_charge:
-            if self.chargesign == '-' and templ['minus']:
-                chargesign = templ['minus']
-            else:
-                chargesign = self.chargesign
+    # Templates that only contain '{}' (e.g. isotope) need no str.format().
+    if all(templ[k] == '{}' for k in ('atomic_mass', 'element', 'count', 'charge')):
+        molecule = [templ['minorjoin'].join(u) for u in zip(amass, elem, count)]
+        if charge:
+            molecule.append(charge)
+        return templ['begin'] + templ['majorjoin'].join(molecule) + templ['end']
 
-            if self.charge == 0:
-                charge = ''
-            elif self.charge == 1:
-                charge = chargesign
-            else:
-                charge = str(self.charge) + chargesign
-        else:
-            charge = ''
+    am_format = templ['atomic_mass'].format
+    el_format = templ['element'].format
+    ct_format = templ['count'].format
+    minorjoin = templ['minorjoin']
 
-        molecule = []
+    # Most templates join everything without separators, build one flat list.
+    if not minorjoin and not templ['majorjoin']:
+        parts = [templ['begin']]
         for am, el, ct in zip(amass, elem, count):
             if am:
-                if (not all_isotopes and
-                    (periodic_table['major isotope'] == am + el).any()):
-                        am_str = ''
-                else:
-                    am_str = templ['atomic_mass'].format(am)
-            else:
-                am_str = ''
-            el_str = templ['element'].format(el)
+                parts.append(am_format(am))
+            parts.append(el_format(el))
             if ct:
-                ct_str = templ['count'].format(ct)
-            else:
-                ct_str = ''
-            m = templ['minorjoin'].join((am_str, el_str, ct_str))
-            molecule.append(m)
-
+                parts.append(ct_format(ct))
         if charge:
-            molecule.append(templ['charge'].format(charge))
+            parts.append(templ['charge'].format(charge))
+        parts.append(templ['end'])
+        return ''.join(parts)
+
+    molecule = []
+    for am, el, ct in zip(amass, elem, count):
+        if am:
+            am_str = am_format(am)
+        else:
+            am_str = ''
+        el_str = el_format(el)
+        if ct:
+            ct_str = ct_format(ct)
+        else:
+            ct_str = ''
+        molecule.append(minorjoin.join((am_str, el_str, ct_str)))
 
-        return templ['begin'] + templ['majorjoin'].join(molecule) + templ['end']
+    if charge:
+        molecule.append(templ['charge'].format(charge))
+
+    return templ['begin'] + templ['majorjoin'].join(molecule) + templ['end']
@@ -26,16 +26,19 @@ except ImportError:
 
 import matplotlib as mpl
 import numpy as np
+import pandas as pd
 import sys, re, platform, pkg_resources, six
 from pyparsing import ParseException
-from itertools import combinations
 from interference_calculator.main import interference, standard_ratio
 from interference_calculator.molecule import Molecule, periodic_table
 from interference_calculator.ui_help import *
 from interference_calculator import __version__
 
 _isotope_rx = re.compile(r'(\d*[A-Z][a-z]{0,2})')
-_charges_rx = re.compile(r'(\d+)')
+_elements = frozenset(periodic_table['element'])
+
+# Charges are separated by spaces and/or commas.
+_charges_split = re.compile(r'[\s,]+')
 
 # Qt uses 0-255 ints, Matplotlib uses 0-1 floats for RGB
 _red = (193, 24, 78)   #c1184e, fuchsia
@@ -47,14 +50,68 @@ _icon = pkg_resources.resource_filename(__name__, 'icon.svg')
 _display_button_icon = pkg_resources.resource_filename(__name__, 'display_button_icon.svg')
 _help_button_icon = pkg_resources.resource_filename(__name__, 'help_button_icon.svg')
 
+# Maximum number of laid out documents kept by each HTMLDelegate.
+_documents_size = 4096
+
+# Roles for which TableModel.data() returns something.
+_roles = frozenset((QtCore.Qt.DisplayRole, QtCore.Qt.TextAlignmentRole,
+                    QtCore.Qt.EditRole, QtCore.Qt.BackgroundRole))
+
+# Alignment of the formula column and of the other columns.
+_align_left = QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter
+_align_right = QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter
+
+# Background of the target row(s).
+_target_background = QtGui.QColor(*_red, alpha=32)
+
 mpl.rc('font', family='sans-serif', size=14)
 
+def _html_formula(molec):
+    """ Format molecule as html, or return as is if it is not a formula. """
+    try:
+        m = Molecule(molec)
+    except ParseException:
+        return molec
+    else:
+        return m.formula(style='html', all_isotopes=True)
+
+# Display format per column for each type of table; remaining columns use '{}'.
+_formats = {
+    # formula, mass, mass difference, MRP, probability
+    'interference': (_html_formula, '{:.6f}'.format, '{:.7f}'.format,
+                     '{:.2f}'.format, '{:.5g}'.format),
+    # formula, mass, rel. abundance, ratio, inverse ratio
+    'std_ratios': (_html_formula, '{:.6f}'.format, '{:.5g}'.format,
+                   '{:.5g}'.format, '{:.2f}'.format)
+}
+
 class TableModel(QtCore.QAbstractTableModel):
     """ Take a pandas DataFrame and set data in a QTableModel (read-only). """
     def __init__(self, data, table='interference', parent=None):
         QtCore.QAbstractTableModel.__init__(self, parent=parent)
         self._data = data
         self.table = table
+        # Plain arrays of the values for quick cell access. Sorting only
+        # changes _order, the row in data for each row in the view.
+        self._values = self._data.values
+        self._target = self._data['target'].values
+        self._order = np.arange(self._data.shape[0])
+        self._columns = self._data.columns.tolist()
+        self._index = self._data.index.tolist()
+        # Display strings per column, per row in data; None until the
+        # row is first shown, see data().
+        self._display = [[None] * self._data.shape[0] for c in range(self._data.shape[1])]
+
+    def _format_rows(self, rows):
+        """ Format the cells of rows (in data) for display once,
+            instead of on every paint.
+        """
+        rows = [r for r in rows if self._display[0][r] is None]
+        formats = _formats[self.table]
+        for c, column in enumerate(self._display):
+            fmt = formats[c] if c < len(formats) else '{}'.format
+            for r in rows:
+                column[r] = fmt(self._values[r, c])
 
     def rowCount(self, parent=None):
         return self._data.shape[0]
@@ -63,80 +120,59 @@ class TableModel(QtCore.QAbstractTableModel):
         return self._data.shape[1]
 
     def data(self, index, role=QtCore.Qt.DisplayRole):
-        if index.isValid():
+        # Qt asks for many roles per cell; return early for the ones not set here.
+        if role in _roles and index.isValid():
             if role == QtCore.Qt.DisplayRole:
-                if self.table == 'interference':
-                    if index.column() == 0:
-                        # formula
-                        molec = self._data.iloc[index.row(), index.column()]
-                        try:
-                            m = Molecule(molec)
-                        except ParseException:
-                            return molec
-                        else:
-                            return m.formula(style='html', all_isotopes=True)
-                    elif index.column() == 1:
-                        # mass
-                        return '{:.6f}'.format(self._data.iloc[index.row(), index.column()])
-                    elif index.column() == 2:
-                        # mass difference
-                        return '{:.7f}'.format(self._data.iloc[index.row(), index.column()])
-                    elif index.column() == 3:
-                        # MRP
-                        return '{:.2f}'.format(self._data.iloc[index.row(), index.column()])
-                    elif index.column() == 4:
-                        # probability
-                        return '{:.5g}'.format(self._data.iloc[index.row(), index.column()])
-                    else:
-                        return '{}'.format(self._data.iloc[index.row(), index.column()])
-                elif self.table == 'std_ratios':
-                    if index.column() == 0:
-                        # formula
-                        m = Molecule(self._data.iloc[index.row(), index.column()])
-                        return m.formula(style='html', all_isotopes=True)
-                    elif index.column() == 1:
-                        # mass
-                        return '{:.6f}'.format(self._data.iloc[index.row(), index.column()])
-                    elif index.column() in (2, 3):
-                        # rel. abundance and ratio
-                        return '{:.5g}'.format(self._data.iloc[index.row(), index.column()])
-                    elif index.column() == 4:
-                        # inverse ratio
-                        return '{:.2f}'.format(self._data.iloc[index.row(), index.column()])
-                    else:
-                        return '{}'.format(self._data.iloc[index.row(), index.column()])
+                row = self._order[index.row()]
+                if self._display[0][row] is None:
+                    self._format_rows([row])
+                return self._display[index.column()][row]
             elif role == QtCore.Qt.TextAlignmentRole:
                 if index.column() == 0:
-                    return QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter
+                    return _align_left
                 else:
-                    return QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter
+                    return _align_right
             elif role == QtCore.Qt.EditRole:
-                return self._data.iloc[index.row(), index.column()]
+                return self._values[self._order[index.row()], index.column()]
             elif role == QtCore.Qt.BackgroundRole:
-                if self._data['target'].iloc[index.row()]:
-                    return QtGui.QColor(*_red, alpha=32)
+                if self._target[self._order[index.row()]]:
+                    return _target_background
 
     def headerData(self, rowcol, orientation, role):
         if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
-            return self._data.columns[rowcol]
+            return self._columns[rowcol]
         if orientation == QtCore.Qt.Vertical and role == QtCore.Qt.DisplayRole:
-            return self._data.index[rowcol]
+            return self._index[self._order[rowcol]]
 
     def sort(self, column, order):
         # QtCore.Qt.AscendingOrder = 0
         # QtCore.Qt.DescendingOrder = 1
         ascending = not bool(order)
-        colname = self._data.columns[column]
-        self._data.sort_values(colname, ascending=ascending, inplace=True)
-        self.beginResetModel()
-        self.endResetModel()
+        self.layoutAboutToBeChanged.emit()
+        # Sort the column in the current view order, then reorder the rows.
+        values = self._data.iloc[self._order, column].reset_index(drop=True)
+        rank = values.sort_values(ascending=ascending).index.values
+        old_order = self._order
+        self._order = old_order[rank]
+
+        # Move persistent indexes, such as the selection, along with their rows.
+        view_row = np.empty_like(self._order)
+        view_row[self._order] = np.arange(len(self._order))
+        old = self.persistentIndexList()
+        new = [self.index(int(view_row[old_order[i.row()]]), i.column()) for i in old]
+        self.changePersistentIndexList(old, new)
+        self.layoutChanged.emit()
 
     def copy(self, selection):
-        mask = np.zeros(self._data.shape, dtype=bool)
-        for s in selection:
-            mask[s.row(), s.column()] = True
-        output = self._data.where(mask)
-        output = output.dropna(how='all', axis=(0,1))
+        # Copy the block of rows and columns that have a selected cell,
+        # blanking the cells in it that are not selected.
+        if not selection:
+            return
+        rows, row_pos = np.unique([s.row() for s in selection], return_inverse=True)
+        cols, col_pos = np.unique([s.column() for s in selection], return_inverse=True)
+        mask = np.zeros((len(rows), len(cols)), dtype=bool)
+        mask[row_pos, col_pos] = True
+        output = self._data.iloc[self._order[rows], cols].where(mask)
         pasteboard = widgets.QApplication.clipboard()
         pasteboard.setText(output.to_csv(index=False))
 
@@ -172,6 +208,23 @@ class HTMLDelegate(widgets.QStyledItemDelegate):
     """ Display HTML in a table cell. """
     def __init__(self, parent=None):
         widgets.QStyledItemDelegate.__init__(self, parent=parent)
+        # Laid out documents, keyed on html and width.
+        self._documents = {}
+
+    def document(self, html, width):
+        """ Return a QTextDocument with html laid out to width, reusing
+            the document from an earlier call if there is one.
+        """
+        key = (html, width)
+        textbox = self._documents.get(key)
+        if textbox is None:
+            textbox = QtGui.QTextDocument()
+            textbox.setHtml(html)
+            textbox.setTextWidth(width)
+            if len(self._documents) >= _documents_size:
+                self._documents.clear()
+            self._documents[key] = textbox
+        return textbox
 
     def createEditor(self, parent, option, index):
         """ disable editing """
@@ -183,9 +236,7 @@ class HTMLDelegate(widgets.QStyledItemDelegate):
         self.initStyleOption(options, index)
 
         style = widgets.QApplication.style()
-        textbox = QtGui.QTextDocument()
-        textbox.setHtml(options.text)
-        textbox.setTextWidth(options.rect.width())
+        textbox = self.document(options.text, options.rect.width())
         options.text = ''
         style.drawControl(widgets.QStyle.CE_ItemViewItem, options, painter)
         context = QtGui.QAbstractTextDocumentLayout.PaintContext()
@@ -202,11 +253,9 @@ class HTMLDelegate(widgets.QStyledItemDelegate):
         options = widgets.QStyleOptionViewItem(option)
         self.initStyleOption(options, index)
 
-        textbox = QtGui.QTextDocument()
-        textbox.setHtml(options.text)
-        textbox.setTextWidth(options.rect.width())
-
-        return QtCore.QSize(textbox.idealWidth(), textbox.size().height())
+        textbox = self.document(options.text, options.rect.width())
+        return QtCore.QSize(int(np.ceil(textbox.idealWidth())),
+                            int(np.ceil(textbox.size().height())))
 
 
 class Spectrum(widgets.QWidget):
@@ -230,6 +279,8 @@ class Spectrum(widgets.QWidget):
         self._data = None
         self.x = None
         self.y = None
+        self.molecules = None
+        self.targets = None
         self.label_offset = (0, 24)
         self.minimum = 0
 
@@ -248,6 +299,8 @@ class Spectrum(widgets.QWidget):
         self._data = newdata.copy().sort_values('probability', ascending=False)
         self.x = self._data['mass/charge'].values
         self.y = self._data['probability'].values
+        self.molecules = self._data['molecule'].values
+        self.targets = self._data['target'].values.astype(bool)
 
     def plot_spectrum(self, data=None):
         """ Plot the spectrum. """
@@ -264,63 +317,83 @@ class Spectrum(widgets.QWidget):
         self.ax.minorticks_on()
         self.ax.grid(True)
 
-        self.colours = [_redF if c else _blueF for c in self.data['target']]
+        self.colours = np.where(self.targets[:, np.newaxis], _redF, _blueF)
 
         self.data_points = self.ax.scatter(self.x, self.y, marker='D', c=self.colours)
 
-        self.data_lines = self.ax.vlines(self.x, [self.minimum] * self.data.shape[0],
+        self.data_lines = self.ax.vlines(self.x, self.minimum,
                                     self.y, colors=self.colours, linewidth=3)
 
         self.renderer = self.fig.canvas.get_renderer()
 
         self.labels = []
-        for molec, x, y in zip(self.data['molecule'].iloc[:self.MAX_LABELS], self.x, self.y):
+        for molec, x, y in zip(self.molecules[:self.MAX_LABELS], self.x, self.y):
             m = Molecule(molec)
             l = m.formula(all_isotopes=True, style='latex')
 
             label = self.ax.text(x, y, l, horizontalalignment='center')
-
-            # Set initial offset
-            self.shift_label(label)
             self.labels.append(label)
 
-        # Iterate over labels until none overlap
+        # Set initial offset
+        self.shift_labels(self.labels)
+
+        # Iterate over labels until none overlap. Label extents are measured
+        # once, and again only for a label that was shifted.
+        boxes = np.array([self.label_extent(l) for l in self.labels]).reshape(-1, 4)
         done = False
         while not done:
             done = True
-            for label1, label2 in combinations(self.labels, 2):
-                box1 = label1.get_window_extent(self.renderer)
-                box2 = label2.get_window_extent(self.renderer)
-                if box1.intersection(box1, box2):
-                    self.shift_label(label2)
+            for i in range(len(self.labels) - 1):
+                xmin, ymin, xmax, ymax = boxes[i]
+                others = boxes[i+1:]
+                # Same test as Bbox.intersection(), touching boxes overlap.
+                overlap = ((np.maximum(xmin, others[:, 0]) <= np.minimum(xmax, others[:, 2])) &
+                           (np.maximum(ymin, others[:, 1]) <= np.minimum(ymax, others[:, 3])))
+                shifted = np.nonzero(overlap)[0] + i + 1
+                if len(shifted):
+                    self.shift_labels([self.labels[j] for j in shifted])
+                    for j in shifted:
+                        boxes[j] = self.label_extent(self.labels[j])
                     # There was an overlap, check again.
                     done = False
 
-        # Draw thin lines from datapoints to labels
-        for label, x, y in zip(self.labels, self.x, self.y):
-            lx, ly = label.get_position()
-            self.ax.plot((x,lx), (y, ly), linewidth=0.5, color='black')
+        # Draw thin lines from datapoints to labels, as one collection
+        segments = [((x, y), label.get_position())
+                    for label, x, y in zip(self.labels, self.x, self.y)]
+        self.label_lines = self.ax.add_collection(
+            mpl.collections.LineCollection(segments, linewidth=0.5, colors='black'))
 
         # For log plot
-        self.minimum = self.data['probability'].min()/100
+        self.minimum = self.y.min()/100
         self.ax.autoscale()
         self.ax.set_ybound(lower=self.minimum)
         self.canvas.draw()
 
+    def label_extent(self, label):
+        """ Return xmin, ymin, xmax, ymax of text label 'label' in pixels. """
+        box = label.get_window_extent(self.renderer)
+        return box.xmin, box.ymin, box.xmax, box.ymax
+
     def shift_label(self, label, offset=None):
         """ Shift text label 'label' up by 'offset' amount (in pixels).
             Label must be a matplotlib.text.Text object. Offset defaults
             to Spectrum.label_offset.
         """
+        self.shift_labels([label], offset)
+
+    def shift_labels(self, labels, offset=None):
+        """ Shift all text labels in 'labels' up by 'offset' amount,
+            transforming their positions in one go. See shift_label().
+        """
+        if not labels:
+            return
         if not offset:
             offset = self.label_offset
 
-        xpos, ypos = label.get_position()
-        xpos_px, ypos_px = self.ax.transData.transform((xpos, ypos))
-        xpos_px += offset[0]
-        ypos_px += offset[1]
-        xpos, ypos = self.ax.transData.inverted().transform((xpos_px, ypos_px))
-        label.set_position((xpos, ypos))
+        trans = self.ax.transData
+        pos_px = trans.transform([label.get_position() for label in labels]) + offset
+        for label, (xpos, ypos) in zip(labels, trans.inverted().transform(pos_px)):
+            label.set_position((xpos, ypos))
 
 
 class MainWindow(widgets.QMainWindow):
@@ -491,12 +564,12 @@ class MainWidget(widgets.QWidget):
         """ Validate input for atoms_input.
             Returns True on proper validation, False on error.
         """
-        atoms = re.findall(_isotope_rx, str(self.atoms_input.text()))
+        atoms = _isotope_rx.findall(str(self.atoms_input.text()))
         if not atoms:
             self.warn('Enter at least one element or isotope.')
             return False
         for a in atoms:
-            if not (periodic_table['element'] == a).any(): 
+            if a not in _elements:
                 self.warn('{} is not an element or missing from the periodic table.'.format(a))
                 return False
         self.atoms = atoms
@@ -506,19 +579,16 @@ class MainWidget(widgets.QWidget):
         """ Validate input for charges_input.
             Returns True on correct input, False on error.
         """
-        charges = re.findall(_charges_rx, str(self.charges_input.text()))
+        charges = [c for c in _charges_split.split(str(self.charges_input.text())) if c]
         if not charges:
             self.warn('Enter at least one charge value.')
             return False
-        icharges = []
         for c in charges:
-            try:
-                c = int(c)
-            except ValueError:
+            # Digits 0-9 only, the sign is set separately.
+            if c.strip('0123456789'):
                 self.warn('{} is not a valid charge.'.format(c))
                 return False
-            icharges.append(c)
-        self.charges = icharges
+        self.charges = [int(c) for c in charges]
         return True
 
     def check_mz_input(self):
@@ -618,7 +688,7 @@ class MainWidget(widgets.QWidget):
             m = Molecule(self.mz)
             target_data = standard_ratio(m.elements)
             target_data['target'] = True
-            data = data.append(target_data)
+            data = pd.concat([data, target_data])
         data.index = range(1, data.shape[0] + 1)
 
         model = TableModel(data, table='std_ratios')
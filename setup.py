@@ -51,8 +51,7 @@ setup(
         'matplotlib',
         'pandas',
         'pyparsing',
-        pyqtdep,
-        'scipy'
+        pyqtdep
     ],
     entry_points = {
         'gui_scripts': ['interference_calculator=interference_calculator.ui:run']